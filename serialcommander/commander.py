@@ -1,9 +1,13 @@
 import math
+import operator
+from functools import reduce
 from typing import Dict
 
 from nmigen import (
     Elaboratable,
+    Memory,
     Module,
+    Mux,
     Signal
 )
 from nmigen.build import Platform
@@ -20,43 +24,57 @@ class Commander(Elaboratable):
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
         
-        activeCommand = Signal(range(len(self.commands) + 1))
+        # One-hot, bit i is set while the i-th command has control of the UART
+        activeCommand = Signal(len(self.commands))
         activeStart = Signal()
         activeDone = Signal()
 
-        indexToMod = {} # Command index to submod
-        letterToIndex = {}
+        # Lookup table from a received character to its one-hot activeCommand,
+        # or 0 for characters that aren't mapped to a command
+        lut = [0] * 2**len(self.uart.rx_data)
 
-        i = 1
-        for k, submod in self.commands.items():
+        # Every command's TX outputs gated by its bit of activeCommand
+        tx_datas = []
+        tx_rdys = []
+
+        for i, (k, submod) in enumerate(self.commands.items()):
             setattr(m.submodules, 'command' + k, submod)
-            indexToMod[i] = submod
-            letterToIndex[k] = i
-            i += 1
-
-        with m.Switch(activeCommand):
-            with m.Case(0):
-                m.d.comb += [
-                    self.uart.tx_data.eq(0),
-                    self.uart.tx_rdy.eq(0),
-                    activeDone.eq(0),
-                ]
-                for _, submod in self.commands.items():
-                    submod.start.eq(0)
-                    submod.tx_ack.eq(0)
-
-            for i in range(1, len(self.commands) + 1):
-                with m.Case(i):
-                    m.d.comb += [
-                        self.uart.tx_data.eq(indexToMod[i].tx_data),
-                        self.uart.tx_rdy.eq(indexToMod[i].tx_rdy),
-                        indexToMod[i].tx_ack.eq(self.uart.tx_ack),
-
-                        indexToMod[i].start.eq(activeStart),
-                        activeDone.eq(indexToMod[i].done),
-                    ]
-
-        with m.FSM() as fsm:
+            lut[ord(k)] = 1 << i
+
+            active = activeCommand[i]
+            tx_datas.append(Mux(active, submod.tx_data, 0))
+            tx_rdys.append(active & submod.tx_rdy)
+            m.d.comb += [
+                submod.tx_ack.eq(active & self.uart.tx_ack),
+                submod.start.eq(active & activeStart),
+            ]
+
+        # Only one bit of activeCommand is ever set so OR-ing the gated outputs
+        # together selects the active command with a balanced OR tree rather
+        # than an N-way mux
+        m.d.comb += [
+            self.uart.tx_data.eq(reduce(operator.or_, tx_datas)),
+            self.uart.tx_rdy.eq(reduce(operator.or_, tx_rdys)),
+            # Only a started command can finish so done needs no gating
+            activeDone.eq(reduce(operator.or_, [c.done for c in self.commands.values()])),
+        ]
+
+        letters = Memory(width=len(self.commands), depth=len(lut), init=lut)
+        m.submodules.letters = letters_port = letters.read_port(domain="comb")
+        m.d.comb += letters_port.addr.eq(self.uart.rx_data)
+
+        # Register activeDone before edge detecting it so that the OR across
+        # every command's done isn't in the same path as the FSM logic
+        activeDoneReg = Signal()
+        done_last = Signal()
+        m.d.sync += [
+            activeDoneReg.eq(activeDone),
+            done_last.eq(activeDoneReg),
+        ]
+
+        # Only four states, so binary is already as small as it gets
+        with m.FSM(reset="WAIT_MESSAGE", domain="sync", name="commander") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "binary"
             with m.State("WAIT_MESSAGE"):
                 m.d.sync += self.uart.rx_ack.eq(0)
                 with m.If(self.uart.rx_rdy):
@@ -64,13 +82,11 @@ class Commander(Elaboratable):
 
             with m.State("READ_CHAR"):
                 m.d.sync += self.uart.rx_ack.eq(1)
-                with m.Switch(self.uart.rx_data):
-                    for k, i in letterToIndex.items():
-                        with m.Case(ord(k)):
-                            m.d.sync += activeCommand.eq(i)
-                            m.next = "RUN_TASK_START"
-                    with m.Default():
-                        m.next = "WAIT_MESSAGE"
+                with m.If(letters_port.data != 0):
+                    m.d.sync += activeCommand.eq(letters_port.data)
+                    m.next = "RUN_TASK_START"
+                with m.Else():
+                    m.next = "WAIT_MESSAGE"
 
             with m.State("RUN_TASK_START"):
                 m.d.sync += self.uart.rx_ack.eq(0)
@@ -79,10 +95,62 @@ class Commander(Elaboratable):
 
             with m.State("RUN_TASK_WAIT"):
                 m.d.sync += activeStart.eq(0)
-                done_last = Signal()
-                m.d.sync += done_last.eq(activeDone)
-                with m.If(activeDone & ~done_last):
+                with m.If(activeDoneReg & ~done_last):
                     m.d.sync += activeCommand.eq(0)
                     m.next = "WAIT_MESSAGE"
 
         return m
+
+def test_commander_routing():
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
+    from serialcommander.toggler import Toggler
+
+    class TestRig(Elaboratable):
+        def elaborate(self, platform: Platform) -> Module:
+            m = Module()
+
+            self.a = Toggler()
+            self.b = Toggler()
+            self.uart = UART(divisor=TEST_DIVISOR)
+
+            m.submodules.uart = self.uart
+            m.submodules.commander = Commander(self.uart, {
+                'a': self.a,
+                'b': self.b
+            })
+
+            return m
+
+        def ports(self):
+            return [self.uart.rx_i, self.uart.tx_o, self.a.output, self.b.output]
+
+    rig = TestRig()
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
+
+    def wait(n):
+        for i in range(n):
+            yield
+
+    def transmit_proc():
+        # Only the command that was sent should ever see start
+        yield from rig.uart.test_send_char('a')
+        yield from wait(5)
+        assert (yield rig.a.output)
+        assert not (yield rig.b.output)
+
+        yield from rig.uart.test_send_char('b')
+        yield from wait(5)
+        assert (yield rig.a.output)
+        assert (yield rig.b.output)
+
+        # Unmapped characters are ignored
+        yield from rig.uart.test_send_char('c')
+        yield from wait(5)
+        assert (yield rig.a.output)
+        assert (yield rig.b.output)
+
+    sim.add_sync_process(transmit_proc)
+
+    with trace(sim, "commander.vcd"):
+        sim.run()
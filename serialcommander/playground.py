@@ -10,6 +10,7 @@ from nmigen.sim import Simulator
 from serialcommander.commander import Commander
 from serialcommander.uart import UART
 from serialcommander.printer import DecimalSignalPrinter
+from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, trace
 from serialcommander.trigger import Trigger
 
 if __name__ == '__main__':
@@ -28,7 +29,7 @@ if __name__ == '__main__':
             with m.Elif(decrement.output):
                 m.d.sync += counter.eq(counter - 1)
                 
-            self.uart = UART(divisor=5)
+            self.uart = UART(divisor=TEST_DIVISOR)
             m.submodules.uart = self.uart
             m.submodules.commander = Commander(self.uart, {
                 '\n': self.printer,
@@ -40,19 +41,35 @@ if __name__ == '__main__':
 
     rig = TestRig()
     sim = Simulator(rig)
-    sim.add_clock(1e-6)
+    sim.add_clock(CLOCK_PERIOD)
+
+    # Polling stdin and flushing stdout are far slower than simulating a
+    # cycle, so only do them every POLL_INTERVAL cycles
+    POLL_INTERVAL = 64
 
     def playground_proc():
+        stdin = sys.stdin.fileno()
+        poll = select.select
+        tx_o = rig.uart.tx_o
+        received = []
+
+        cycle = 0
         while True:
-            if select.select([sys.stdin.fileno()], [], [], 0.0)[0]:
-                c = sys.stdin.read(1)
-                # Note that on a real device there is no echo unless you
-                # configure it client-side in your serial terminal
-                print(c, end='', flush=True)
-                yield from rig.uart.test_send_char(c)
+            cycle += 1
+            if cycle % POLL_INTERVAL == 0:
+                if received:
+                    print(''.join(received), end='', flush=True)
+                    received.clear()
+
+                if poll([stdin], [], [], 0.0)[0]:
+                    c = sys.stdin.read(1)
+                    # Note that on a real device there is no echo unless you
+                    # configure it client-side in your serial terminal
+                    print(c, end='', flush=True)
+                    yield from rig.uart.test_send_char(c)
 
-            if not (yield rig.uart.tx_o):
-                print((yield from rig.uart.test_receive_char()), end='', flush=True)
+            if not (yield tx_o):
+                received.append((yield from rig.uart.test_receive_char()))
 
             yield
 
@@ -61,5 +78,6 @@ if __name__ == '__main__':
     tattr = termios.tcgetattr(sys.stdin.fileno())
     tty.setcbreak(sys.stdin.fileno(), termios.TCSANOW)
 
-    with sim.write_vcd("playground.vcd"):
+    # Set SC_TRACE to record playground.vcd, which grows quickly
+    with trace(sim, "playground.vcd"):
         sim.run()
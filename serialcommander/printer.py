@@ -1,5 +1,3 @@
-import math
-
 from nmigen import (
         Cat,
         Elaboratable,
@@ -12,66 +10,104 @@ from nmigen.build import Platform
 
 from serialcommander.task import CommandTask
 
-class TextMemoryPrinter(CommandTask):
-    """Prints a null terminated ASCII string with a trailing newline"""
-    def __init__(self, mem: Memory, length: int):
+class _ByteStreamer(CommandTask):
+    """Base class for tasks that print, owning the tx_rdy/tx_ack handshake with the UART
+
+    Subclasses start from ``super().elaborate(platform)`` and hold ``byte_valid``
+    high with the next character on ``byte_in``. ``byte_ack`` goes high for a
+    cycle once it has been sent, at which point the subclass should move on
+    to its next character or drop ``byte_valid``.
+    """
+    def __init__(self):
+        super().__init__()
+
+        self.byte_in = Signal(8)
+        self.byte_valid = Signal()
+        self.byte_ack = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        tx_ack_last = Signal()
+        m.d.sync += tx_ack_last.eq(self.tx_ack)
+
+        # Force one-hot rather than leaving it to Yosys' fsm_recode heuristics
+        with m.FSM(reset="IDLE", domain="sync", name="handshake") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "one-hot"
+            with m.State("IDLE"):
+                with m.If(self.byte_valid):
+                    # Tell the UART we're ready
+                    m.d.sync += [
+                        self.tx_data.eq(self.byte_in),
+                        self.tx_rdy.eq(1),
+                    ]
+                    m.next = "HANDSHAKE"
+            with m.State("HANDSHAKE"):
+                # The ack going low means the UART has taken the byte
+                with m.If(~self.tx_ack):
+                    m.d.sync += self.tx_rdy.eq(0)
+                # The ack going high again means it's been sent
+                with m.If(self.tx_ack & ~tx_ack_last):
+                    m.d.comb += self.byte_ack.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+class TextMemoryPrinter(_ByteStreamer):
+    """Prints a null terminated ASCII string with a trailing newline
+
+    With ``use_bram=False`` the memory is read asynchronously, which saves a
+    cycle per character but keeps it from being inferred as block RAM.
+    """
+    def __init__(self, mem: Memory, length: int, use_bram: bool=True):
         super().__init__()
         
         self.mem = mem
         self.length = length
+        self.use_bram = use_bram
 
     def elaborate(self, platform: Platform) -> Module:
-        m = Module()
-        m.submodules.r_port = r_port = self.mem.read_port()
+        m = super().elaborate(platform)
+        m.submodules.r_port = r_port = self.mem.read_port(
+            domain="sync" if self.use_bram else "comb")
+        fetch = "FETCH" if self.use_bram else "SEND"
 
-        print_newline = Signal()
+        # Terminate on zero a la C-style strings, sending the
+        # newline in place of the terminator
+        terminator = r_port.data == 0
 
         m_idx = Signal(range(self.length + 1))
         m.d.comb += r_port.addr.eq(m_idx)
-        m.d.comb += self.tx_data.eq(Mux(print_newline, ord('\n'), r_port.data))
+        m.d.comb += self.byte_in.eq(Mux(terminator, ord('\n'), r_port.data))
 
         start_last = Signal()
         m.d.sync += start_last.eq(self.start)
 
-        with m.FSM() as fsm:
+        with m.FSM(reset="IDLE", domain="sync", name="printer") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "one-hot"
             with m.State("IDLE"):
-                m.d.sync += [
-                    self.done.eq(0),
-                    print_newline.eq(0)
-                ]
+                m.d.sync += self.done.eq(0)
                 with m.If(self.start & ~start_last):
-                    m.next = "FETCH"
-            with m.State("FETCH"):
-                # Just waiting for the memory to fetch
-                m.next = "SEND"
+                    m.next = fetch
+            if self.use_bram:
+                with m.State("FETCH"):
+                    # Just waiting for the memory to fetch
+                    m.next = "SEND"
             with m.State("SEND"):
-                # Terminate on zero a la C-style strings
-                with m.If(self.tx_data == 0 & ~print_newline):
-                    m.d.sync += print_newline.eq(1)
-                with m.Else():
-                    # Tell the UART we're ready
-                    m.d.sync += self.tx_rdy.eq(1)
-                    m.next = "WAIT_ACK_DOWN"
-            with m.State("WAIT_ACK_DOWN"):
-                # Wait for the ack to go low (indicating that it's working)
-                with m.If(self.tx_ack == 0):
-                    m.next = "WAIT_ACK_UP"
-            with m.State("WAIT_ACK_UP"):
-                # Wait for the ack to go high (indicating it's done),
-                # then increment the message index
-                m.d.sync += self.tx_rdy.eq(0)
-                with m.If(self.tx_ack):
-                    with m.If(print_newline | (m_idx == (self.length - 1))):
+                m.d.comb += self.byte_valid.eq(1)
+                # Once sent, increment the message index
+                with m.If(self.byte_ack):
+                    with m.If(terminator | (m_idx == (self.length - 1))):
                         m.next = "IDLE"
                         m.d.sync += m_idx.eq(0)
                         m.d.sync += self.done.eq(1)
                     with m.Else():
-                        m.next = "FETCH"
+                        m.next = fetch
                         m.d.sync += m_idx.eq(m_idx + 1)
 
         return m
 
-class BinarySignalPrinter(CommandTask):
+class BinarySignalPrinter(_ByteStreamer):
     """Prints a signal in binary with LSB first"""
     def __init__(self, signal: Signal):
         super().__init__()
@@ -80,106 +116,89 @@ class BinarySignalPrinter(CommandTask):
         self.digits = len(signal)
 
     def elaborate(self, platform: Platform) -> Module:
-        m = Module()
+        m = super().elaborate(platform)
 
-        snapshot = Signal(len(self.signal))
-        digit = Signal(range(self.digits))
-        char = Signal(8)
+        # Only the one-hot mask moves per bit, the latched value stays put
+        latched = Signal(len(self.signal))
+        bit_mask = Signal(len(self.signal), reset=1)
 
         start_last = Signal()
         m.d.sync += start_last.eq(self.start)
 
-        m.d.comb += self.tx_data.eq(char)
+        m.d.comb += self.byte_in.eq(Mux((latched & bit_mask).any(), ord('1'), ord('0')))
 
-        with m.FSM() as fsm:
+        with m.FSM(reset="IDLE", domain="sync", name="printer") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "one-hot"
             with m.State("IDLE"):
                 m.d.sync += self.done.eq(0)
                 with m.If(self.start & ~start_last):
                     m.d.sync += [
-                        snapshot.eq(self.signal),
-                        digit.eq(0),
-                        char.eq(ord('0'))
+                        latched.eq(self.signal),
+                        bit_mask.eq(1),
                     ]
                     m.next = "SEND"
             with m.State("SEND"):
-                with m.If(snapshot[0]):
-                    m.d.sync += [
-                        char.eq(ord('1'))
-                    ]
-                with m.Else():
-                    m.d.sync += [
-                        char.eq(ord('0'))
-                    ]
-                m.d.sync += self.tx_rdy.eq(1)
-                m.next = "WAIT_ACK_DOWN"
-            with m.State("WAIT_ACK_DOWN"):
-                # Wait for the ack to go low (indicating that it's working)
-                with m.If(self.tx_ack == 0):
-                    m.next = "WAIT_ACK_UP"
-            with m.State("WAIT_ACK_UP"):
-                # Wait for the ack to go high (indicating it's done),
-                # then process the next digit
-                m.d.sync += self.tx_rdy.eq(0)
-                with m.If(self.tx_ack):
-                    with m.If(digit < self.digits - 1):
-                        m.d.sync += [
-                            snapshot.eq(Cat(snapshot[1:], 0)),
-                            digit.eq(digit + 1),
-                        ]
-                        m.next = "SEND"
+                m.d.comb += self.byte_valid.eq(1)
+                # Once sent, process the next digit
+                with m.If(self.byte_ack):
+                    with m.If(~bit_mask[-1]):
+                        m.d.sync += bit_mask.eq(bit_mask << 1)
                     with m.Else():
                         m.d.sync += self.done.eq(1)
                         m.next = "IDLE"
 
         return m
 
-class BinaryMemoryPrinter(CommandTask):
-    """Prints words from a Memory instance with LSB first."""
+class BinaryMemoryPrinter(_ByteStreamer):
+    """Prints words from a Memory instance with LSB first.
+
+    With ``use_bram=False`` the memory is read asynchronously, which saves a
+    cycle per word but keeps it from being inferred as block RAM.
+    """
 
-    def __init__(self, mem: Memory, width: int, length: int):
+    def __init__(self, mem: Memory, width: int, length: int, use_bram: bool=True):
         super().__init__()
         
         self.mem = mem
         self.width = width
         self.length = length
+        self.use_bram = use_bram
 
     def elaborate(self, platform: Platform) -> Module:
-        m = Module()
-        m.submodules.r_port = r_port = self.mem.read_port()
+        m = super().elaborate(platform)
+        m.submodules.r_port = r_port = self.mem.read_port(
+            domain="sync" if self.use_bram else "comb")
+        fetch = "FETCH" if self.use_bram else "LATCH"
 
         m_idx = Signal(range(self.length + 1))
         b_idx = Signal(range(self.width + 1)) 
+        word = Signal(self.width)
 
         m.d.comb += r_port.addr.eq(m_idx)
-        with m.If((r_port.data & (1 << b_idx)) > 0):
-            m.d.comb += self.tx_data.eq(ord('1'))
-        with m.Else():
-            m.d.comb += self.tx_data.eq(ord('0'))
+        m.d.comb += self.byte_in.eq(Mux(word.bit_select(b_idx, 1), ord('1'), ord('0')))
 
         start_last = Signal()
         m.d.sync += start_last.eq(self.start)
 
-        with m.FSM() as fsm:
+        with m.FSM(reset="IDLE", domain="sync", name="printer") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "one-hot"
             with m.State("IDLE"):
                 m.d.sync += self.done.eq(0)
                 with m.If(self.start & ~start_last):
-                    m.next = "FETCH"
-            with m.State("FETCH"):
-                # Just waiting for the memory to fetch
+                    m.next = fetch
+            if self.use_bram:
+                with m.State("FETCH"):
+                    # Just waiting for the memory to fetch
+                    m.next = "LATCH"
+            with m.State("LATCH"):
+                # Register the word so the bit select doesn't
+                # hang directly off of the memory's output
+                m.d.sync += word.eq(r_port.data)
                 m.next = "SEND"
             with m.State("SEND"):
-                # Tell the UART we're ready
-                m.d.sync += self.tx_rdy.eq(1)
-                m.next = "WAIT_ACK_DOWN"
-            with m.State("WAIT_ACK_DOWN"):
-                # Wait for the ack to go low (indicating that it's working)
-                with m.If(self.tx_ack == 0):
-                    m.next = "WAIT_ACK_UP"
-            with m.State("WAIT_ACK_UP"):
-                # Wait for the ack to go high (indicating it's done),
-                # then increment the message index
-                m.d.sync += self.tx_rdy.eq(0)
-                with m.If(self.tx_ack):
+                m.d.comb += self.byte_valid.eq(1)
+                # Once sent, increment the message index
+                with m.If(self.byte_ack):
                     with m.If((m_idx == (self.length - 1)) & (b_idx == (self.width - 1))):
                         m.next = "IDLE"
                         m.d.sync += m_idx.eq(0)
@@ -189,230 +208,143 @@ class BinaryMemoryPrinter(CommandTask):
                         with m.If(b_idx == (self.width - 1)):
                             m.d.sync += m_idx.eq(m_idx + 1)
                             m.d.sync += b_idx.eq(0)
-                            m.next = "FETCH"
+                            m.next = fetch
                         with m.Else():
                             m.d.sync += b_idx.eq(b_idx + 1)
-                            m.next = "SEND"
 
         return m
 
-class DecimalSignalPrinter(CommandTask):
+class DecimalSignalPrinter(_ByteStreamer):
     """Prints a Signal in decimal with leading zeros so that any valid value has the same length"""
 
     def __init__(self, signal: Signal):
         super().__init__()
         
         self.signal = signal 
-        self.digits = math.ceil(math.log(2**len(signal))/math.log(10))
+        # Exact, unlike taking the log which loses precision on wide signals
+        self.digits = len(str((1 << len(signal)) - 1))
 
     def elaborate(self, platform: Platform) -> Module:
-        m = Module()
+        m = super().elaborate(platform)
+
+        width = len(self.signal)
 
-        snapshot = Signal(len(self.signal))
+        # The binary value sits in the low bits and is shifted up into
+        # BCD digits (least significant digit first) above it
+        scratch = Signal(width + 4*self.digits)
+        bcd = scratch[width:]
+        shift_count = Signal(range(width + 1))
         digit = Signal(range(self.digits))
-        char = Signal(8)
-        base = Signal(len(self.signal))
-        baseExp = Signal(range(self.digits))
+
+        # Double dabble: any digit that is 5 or more gets 3 added before the
+        # shift so that it carries into the next digit once doubled
+        adjusted = Cat(scratch[:width], *[
+            Mux(nibble >= 5, (nibble + 3)[:4], nibble)
+            for nibble in (bcd.word_select(i, 4) for i in range(self.digits))
+        ])
 
         start_last = Signal()
         m.d.sync += start_last.eq(self.start)
 
-        m.d.comb += self.tx_data.eq(char)
+        m.d.comb += self.byte_in.eq(ord('0') + bcd.word_select(digit, 4))
 
-        with m.FSM() as fsm:
+        with m.FSM(reset="IDLE", domain="sync", name="printer") as fsm:
+            fsm.state.attrs["fsm_encoding"] = "one-hot"
             with m.State("IDLE"):
                 m.d.sync += self.done.eq(0)
                 with m.If(self.start & ~start_last):
                     m.d.sync += [
-                        snapshot.eq(self.signal),
+                        scratch.eq(self.signal.as_unsigned()),
+                        shift_count.eq(0),
                         digit.eq(self.digits - 1),
-                        base.eq(1),
-                        baseExp.eq(0),
-                        char.eq(ord('0'))
                     ]
-                    m.next = "MAKE_BASE"
-            with m.State("MAKE_BASE"):
-                # Multiply the base by 10 until we get to the right
-                # base fo rthe given digit
-                with m.If(baseExp < digit):
+                    m.next = "SHIFT"
+            with m.State("SHIFT"):
+                # One bit per cycle, so the conversion always takes
+                # exactly width cycles regardless of the value
+                with m.If(shift_count < width):
                     m.d.sync += [
-                        base.eq((base << 3) + (base << 1)),
-                        baseExp.eq(baseExp + 1)
+                        scratch.eq(adjusted << 1),
+                        shift_count.eq(shift_count + 1),
                     ]
                 with m.Else():
-                    m.next = "COUNTDOWN"
-            with m.State("COUNTDOWN"):
-                # If the base is greater than what's left
-                # print this digit
-                with m.If(snapshot < base):
                     m.next = "SEND"
-                with m.Else():
-                    m.d.sync += [
-                        snapshot.eq(snapshot - base),
-                        char.eq(char + 1),
-                    ]
             with m.State("SEND"):
-                # Tell the UART we're ready
-                m.d.sync += self.tx_rdy.eq(1)
-                m.next = "WAIT_ACK_DOWN"
-            with m.State("WAIT_ACK_DOWN"):
-                # Wait for the ack to go low (indicating that it's working)
-                with m.If(self.tx_ack == 0):
-                    m.next = "WAIT_ACK_UP"
-            with m.State("WAIT_ACK_UP"):
-                # Wait for the ack to go high (indicating it's done),
-                # then process the next digit
-                m.d.sync += self.tx_rdy.eq(0)
-                with m.If(self.tx_ack):
+                m.d.comb += self.byte_valid.eq(1)
+                # Once sent, process the next digit
+                with m.If(self.byte_ack):
                     with m.If(digit > 0):
-                        m.d.sync += [
-                                digit.eq(digit - 1),
-                                base.eq(1),
-                                baseExp.eq(0),
-                                char.eq(ord('0'))
-                            ]
-                        m.next = "MAKE_BASE"
+                        m.d.sync += digit.eq(digit - 1)
                     with m.Else():
                         m.d.sync += self.done.eq(1)
                         m.next = "IDLE"
 
         return m
 
-def test_text_memory_printer():
-    from nmigen.sim import Simulator
+def test_printers():
+    from nmigen import signed
     from serialcommander.commander import Commander
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
     from serialcommander.uart import UART
 
     message = "Hello World\0"
+    words = [0b0001, 0b0110, 0b1001, 0b1000]
+
+    # Every printer shares one rig (and so one elaboration and, with
+    # Verilator, one compile), each behind its own command character
+    cases = [
+        (lambda: TextMemoryPrinter(Memory(width=8, depth=len(message),
+                                          init=[ord(c) for c in message]),
+                                   length=len(message)),
+         message.replace('\0', '\n')),
+        (lambda: TextMemoryPrinter(Memory(width=8, depth=len(message),
+                                          init=[ord(c) for c in message]),
+                                   length=len(message), use_bram=False),
+         message.replace('\0', '\n')),
+        (lambda: DecimalSignalPrinter(Signal(8, reset=128)),
+         '128'),
+        (lambda: DecimalSignalPrinter(Signal(64, reset=(1 << 64) - 1)),
+         str((1 << 64) - 1)),
+        # Signed signals print their raw bits
+        (lambda: DecimalSignalPrinter(Signal(signed(8), reset=-1)),
+         '255'),
+        (lambda: DecimalSignalPrinter(Signal(signed(8), reset=-128)),
+         '128'),
+        (lambda: BinaryMemoryPrinter(Memory(width=4, depth=4, init=words), width=4, length=4),
+         '1000011010010001'),
+        (lambda: BinaryMemoryPrinter(Memory(width=4, depth=4, init=words), width=4, length=4,
+                                     use_bram=False),
+         '1000011010010001'),
+        (lambda: BinarySignalPrinter(Signal(5, reset=0b10101)),
+         '10101'),
+    ]
 
     class TestRig(Elaboratable):
         def elaborate(self, platform: Platform) -> Module:
             m = Module()
 
-            self.printer = TextMemoryPrinter(Memory(width=8,
-                                                    depth=len(message), 
-                                                    init=[ord(c) for c in message]),
-                                               length=len(message))
-            self.uart = UART(divisor=5)
+            self.uart = UART(divisor=TEST_DIVISOR)
             
             m.submodules.uart = self.uart
             m.submodules.commander = Commander(self.uart, {
-                '1': self.printer
+                str(i): printer() for i, (printer, _) in enumerate(cases)
             })
 
             return m
 
-    rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
-
-    def transmit_proc():
-        yield from rig.uart.test_send_char('1')
-        assert (yield from rig.uart.test_expect_string(message.replace('\0','\n')))
-
-    sim.add_sync_process(transmit_proc)
-
-    with sim.write_vcd("text_memory_printer.vcd"):
-        sim.run()
-
-def test_decimal_signal_printer():
-    from nmigen.sim import Simulator
-    from serialcommander.commander import Commander
-    from serialcommander.uart import UART
-
-    class TestRig(Elaboratable):
-        def elaborate(self, platform: Platform) -> Module:
-            m = Module()
-
-            sig = Signal(8, reset=128)
-
-            self.printer = DecimalSignalPrinter(sig)
-            self.uart = UART(divisor=5)
-            
-            m.submodules.uart = self.uart
-            m.submodules.commander = Commander(self.uart, {
-                '1': self.printer
-            })
-
-            return m
-
-    rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
-
-    def transmit_proc():
-        yield from rig.uart.test_send_char('1')
-        assert (yield from rig.uart.test_expect_string('128'))
-
-    sim.add_sync_process(transmit_proc)
-
-    with sim.write_vcd("decimal_signal_printer.vcd"):
-        sim.run()
-
-def test_binary_memory_printer():
-    from nmigen.sim import Simulator
-    from serialcommander.commander import Commander
-    from serialcommander.uart import UART
-
-    class TestRig(Elaboratable):
-        def elaborate(self, platform: Platform) -> Module:
-            m = Module()
-
-            self.printer = BinaryMemoryPrinter(Memory(width=4, depth=4, init=[0b0001, 0b0110, 0b1001, 0b1000]),
-                                               width=4,
-                                               length=4)
-            self.uart = UART(divisor=5)
-            
-            m.submodules.uart = self.uart
-            m.submodules.commander = Commander(self.uart, {
-                '1': self.printer
-            })
-
-            return m
-
-    rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
-
-    def transmit_proc():
-        yield from rig.uart.test_send_char('1')
-        assert (yield from rig.uart.test_expect_string('1000011010010001'))
-
-    sim.add_sync_process(transmit_proc)
-
-    with sim.write_vcd("binary_memory_printer.vcd"):
-        sim.run()
-
-def test_binary_signal_printer():
-    from nmigen.sim import Simulator
-    from serialcommander.commander import Commander
-    from serialcommander.uart import UART
-
-    class TestRig(Elaboratable):
-        def elaborate(self, platform: Platform) -> Module:
-            m = Module()
-
-            sig = Signal(5, reset=0b10101)
-
-            self.printer = BinarySignalPrinter(sig)
-            self.uart = UART(divisor=5)
-            
-            m.submodules.uart = self.uart
-            m.submodules.commander = Commander(self.uart, {
-                '1': self.printer
-            })
-
-            return m
+        def ports(self):
+            return [self.uart.rx_i, self.uart.tx_o]
 
     rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
 
     def transmit_proc():
-        yield from rig.uart.test_send_char('1')
-        assert (yield from rig.uart.test_expect_string('10101'))
+        for i, (_, expected) in enumerate(cases):
+            yield from rig.uart.test_send_char(str(i))
+            assert (yield from rig.uart.test_expect_string(expected))
 
     sim.add_sync_process(transmit_proc)
 
-    with sim.write_vcd("binary_signal_printer.vcd"):
+    with trace(sim, "printers.vcd"):
         sim.run()
@@ -0,0 +1,268 @@
+"""Simulator selection for the self-tests.
+
+By default (``SC_SIM_BACKEND=pysim``) the tests run on nmigen's built-in
+Python simulator. Setting ``SC_SIM_BACKEND=verilator`` instead converts the
+design to Verilog, compiles it with Verilator and drives the compiled model
+from the very same test processes, which is a lot faster per simulated cycle
+for the longer tests. Any other value is an error rather than silently
+falling back to pysim.
+
+Compiled models are cached in ``SC_SIM_CACHE`` (``~/.cache/serialcommander``
+by default) keyed by a hash of the generated Verilog, so reruns skip the
+Verilator compile.
+
+The Verilator backend only supports what the tests need: a single ``sync``
+domain and processes added with ``add_sync_process`` that read, and assign
+constants to, the signals returned by the design's ``ports()`` method.
+"""
+import contextlib
+import ctypes
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+from nmigen import (
+    Elaboratable,
+    Signal
+)
+from nmigen.back import verilog
+from nmigen.hdl.ast import Assign, Const, SignalDict
+from nmigen.hdl.ir import Fragment
+from nmigen.sim import Simulator
+
+# The smallest divisor the UART supports, so every simulated bit costs as few
+# clock cycles as possible, with the clock stretched to keep the bit time
+TEST_DIVISOR = 4
+BIT_PERIOD = 5e-6
+CLOCK_PERIOD = BIT_PERIOD / TEST_DIVISOR
+
+BACKENDS = ("pysim", "verilator")
+
+VERILATOR_FLAGS = ["-O3", "--x-assign", "fast", "--x-initial", "fast", "--no-assert"]
+
+def trace(sim, filename: str):
+    """Writes a VCD of the simulation to ``filename`` if ``SC_TRACE`` is set.
+
+    Tracing every signal change dominates the run time of the tests so it's
+    off unless asked for.
+    """
+    if os.environ.get("SC_TRACE"):
+        return sim.write_vcd(filename)
+    return contextlib.nullcontext()
+
+def simulator(top: Elaboratable):
+    """Returns a simulator for ``top`` using the backend picked by ``SC_SIM_BACKEND``"""
+    backend = os.environ.get("SC_SIM_BACKEND", "pysim")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown SC_SIM_BACKEND {!r}, expected one of {}"
+                         .format(backend, ", ".join(BACKENDS)))
+
+    # Elaborate here, once, and hand the same fragment to whichever backend
+    fragment = Fragment.get(top, platform=None)
+    if backend == "verilator":
+        # The design only exists once elaborated, so ask for the ports after
+        return VerilatorSimulator(fragment, top.ports())
+    return Simulator(fragment)
+
+class VerilatorSimulator:
+    """Runs nmigen sync processes against a Verilator compiled model of ``fragment``
+
+    The processes see the same values as they would under nmigen's simulator:
+    reads return the values from just before the clock edge the process
+    woke up on, and assignments are only picked up by the next edge.
+    """
+    def __init__(self, fragment: Fragment, ports):
+        fragment = fragment.prepare(ports=ports)
+
+        self.clk = fragment.domains["sync"].clk
+        self.rst = fragment.domains["sync"].rst
+
+        text, name_map = verilog.convert_fragment(fragment, name="top")
+
+        self.ports = SignalDict()
+        for i, (signal, direction) in enumerate(fragment.ports.items()):
+            if len(signal) > 64:
+                raise NotImplementedError("Port {} is wider than 64 bits".format(signal.name))
+            self.ports[signal] = (i, direction, _cxx_name(name_map[signal][-1]))
+
+        self.processes = []
+        self.lib = ctypes.CDLL(self._build(text))
+        self.lib.sc_create.restype = ctypes.c_void_p
+        self.lib.sc_destroy.argtypes = [ctypes.c_void_p]
+        self.lib.sc_eval.argtypes = [ctypes.c_void_p]
+        self.lib.sc_get.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.lib.sc_get.restype = ctypes.c_uint64
+        self.lib.sc_set.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint64]
+
+    def _wrapper(self) -> str:
+        gets = []
+        sets = []
+        for i, direction, name in self.ports.values():
+            gets.append("    case {}: return t->{};".format(i, name))
+            if direction == "i":
+                sets.append("    case {}: t->{} = value; break;".format(i, name))
+
+        return _WRAPPER.format(gets="\n".join(gets), sets="\n".join(sets))
+
+    def _build(self, text: str) -> str:
+        wrapper = self._wrapper()
+
+        key = hashlib.sha256("\0".join([text, wrapper] + VERILATOR_FLAGS).encode()).hexdigest()
+        cache = os.environ.get("SC_SIM_CACHE",
+                               os.path.join(os.path.expanduser("~"), ".cache", "serialcommander"))
+        path = os.path.join(cache, key + ".so")
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(cache, exist_ok=True)
+        with tempfile.TemporaryDirectory() as build:
+            with open(os.path.join(build, "top.v"), "w") as f:
+                f.write(text)
+            with open(os.path.join(build, "wrapper.cpp"), "w") as f:
+                f.write(wrapper)
+
+            # Link the model and wrapper into a shared library rather
+            # than an executable so that ctypes can load it
+            subprocess.run([os.environ.get("VERILATOR", "verilator"),
+                            "--cc", "--exe", "--build", *VERILATOR_FLAGS,
+                            "-Wno-fatal", "--top-module", "top", "--Mdir", "obj",
+                            "-CFLAGS", "-fPIC", "-LDFLAGS", "-shared", "-o", "model.so",
+                            "top.v", "wrapper.cpp"],
+                           cwd=build, check=True, stdout=subprocess.DEVNULL)
+
+            # Copy then rename so that concurrent test runs never load a partial file
+            shutil.copy(os.path.join(build, "obj", "model.so"), path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        return path
+
+    def add_clock(self, period: float, *, domain: str="sync"):
+        # The compiled model only sees clock edges so the period doesn't matter
+        assert domain == "sync"
+
+    def add_sync_process(self, process, *, domain: str="sync"):
+        assert domain == "sync"
+        self.processes.append(process)
+
+    def write_vcd(self, *args, **kwargs):
+        # Tracing isn't compiled into the model, so SC_TRACE does nothing here
+        return contextlib.nullcontext()
+
+    def _read(self, signal: Signal) -> int:
+        if signal not in self.ports:
+            raise ValueError("{} is not one of the design's ports()".format(signal.name))
+
+        value = self.lib.sc_get(self.top, self.ports[signal][0])
+        if signal.shape().signed and value & (1 << (len(signal) - 1)):
+            value -= 1 << len(signal)
+        return value
+
+    def _write(self, signal: Signal, value: int):
+        if signal not in self.ports or self.ports[signal][1] != "i":
+            raise ValueError("{} is not an input in the design's ports()".format(signal.name))
+
+        self.lib.sc_set(self.top, self.ports[signal][0], value & ((1 << len(signal)) - 1))
+
+    def _step(self, process, pending) -> bool:
+        """Runs a process up until it waits for the next clock edge,
+        returning False if it finished instead"""
+        response = None
+        while True:
+            try:
+                command = process.send(response)
+            except StopIteration:
+                return False
+
+            response = None
+            if command is None:
+                return True
+            elif isinstance(command, Signal):
+                response = self._read(command)
+            elif (isinstance(command, Assign) and isinstance(command.lhs, Signal)
+                    and isinstance(command.rhs, Const)):
+                pending.append((command.lhs, command.rhs.value))
+            else:
+                raise NotImplementedError("Unsupported command {!r}".format(command))
+
+    def _tick(self):
+        self.lib.sc_set(self.top, self.ports[self.clk][0], 1)
+        self.lib.sc_eval(self.top)
+        self.lib.sc_set(self.top, self.ports[self.clk][0], 0)
+        self.lib.sc_eval(self.top)
+
+    def run(self):
+        self.top = self.lib.sc_create()
+        try:
+            # Verilator zeroes the inputs, so start them from their reset
+            # values like nmigen does (this also holds rst low)
+            for signal, (i, direction, _) in self.ports.items():
+                if direction == "i":
+                    self._write(signal, signal.reset)
+            self.lib.sc_eval(self.top)
+
+            processes = [process() for process in self.processes]
+            while processes:
+                pending = []
+                processes = [p for p in processes if self._step(p, pending)]
+
+                self._tick()
+                for signal, value in pending:
+                    self._write(signal, value)
+                self.lib.sc_eval(self.top)
+        finally:
+            self.lib.sc_destroy(self.top)
+
+def _cxx_name(name: str) -> str:
+    """Verilator's C++ name for a top level port, which escapes anything that
+    isn't a valid C++ identifier (like the ``$1`` nmigen uses to deduplicate)"""
+    out = ""
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if c.isascii() and (c.isalpha() or (out and c.isdigit())):
+            out += c
+        elif c == "_" and name[i + 1:i + 2] == "_":
+            out += "___05F"
+            i += 1
+        elif c == "_":
+            out += c
+        else:
+            out += "__0{:02x}".format(ord(c))
+        i += 1
+    return out
+
+_WRAPPER = """\
+#include <cstdint>
+
+#include "Vtop.h"
+#include "verilated.h"
+
+double sc_time_stamp() {{ return 0; }}
+
+extern "C" {{
+
+void *sc_create() {{ return new Vtop; }}
+
+void sc_destroy(void *top) {{ delete static_cast<Vtop *>(top); }}
+
+void sc_eval(void *top) {{ static_cast<Vtop *>(top)->eval(); }}
+
+uint64_t sc_get(void *top, int port) {{
+    Vtop *t = static_cast<Vtop *>(top);
+    switch (port) {{
+{gets}
+    }}
+    return 0;
+}}
+
+void sc_set(void *top, int port, uint64_t value) {{
+    Vtop *t = static_cast<Vtop *>(top);
+    switch (port) {{
+{sets}
+    }}
+}}
+
+}}
+"""
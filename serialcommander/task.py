@@ -8,7 +8,8 @@ class CommandTask(Elaboratable):
     def __init__(self):
         # This goes high for at least once cycle when the Task has control of the TX ports
         self.start = Signal()
-        # This signals when the Task has completed and TX port control can be surrendered
+        # This signals when the Task has completed and TX port control can be surrendered,
+        # it must stay low unless the Task has been started
         self.done = Signal()
 
         # The character to transmit
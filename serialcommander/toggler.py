@@ -1,4 +1,5 @@
 from nmigen import (
+        Cat,
         Elaboratable,
         Module,
         Signal
@@ -15,23 +16,25 @@ class Toggler(CommandTask):
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        start_last = Signal()
-        m.d.sync += start_last.eq(self.start)
-
-        with m.FSM() as fsm:
-            with m.State("IDLE"):
-                with m.If(self.start & ~start_last):
-                    m.d.sync += self.output.eq(~self.output)
-                    m.d.sync += self.done.eq(1)
-                    m.next = "FINISH"
-            with m.State("FINISH"):
-                    m.d.sync += self.done.eq(0)
-                    m.next = "IDLE"
+        # The output and the last value of start share one register,
+        # updated with a single assignment
+        state = Signal(2)
+        output, start_last = state[0], state[1]
+
+        # Everything happens in the cycle start rises, so there's no need
+        # for an FSM to come back to idle
+        pulse = Signal()
+        m.d.comb += [
+            pulse.eq(self.start & ~start_last),
+            self.done.eq(pulse),
+            self.output.eq(output),
+        ]
+        m.d.sync += state.eq(Cat(output ^ pulse, self.start))
 
         return m
 
 def test_toggler():
-    from nmigen.sim import Simulator
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
     from serialcommander.commander import Commander
     from serialcommander.uart import UART
 
@@ -40,7 +43,7 @@ def test_toggler():
             m = Module()
 
             self.toggler = Toggler()
-            self.uart = UART(divisor=5)
+            self.uart = UART(divisor=TEST_DIVISOR)
             
             m.submodules.uart = self.uart
             m.submodules.commander = Commander(self.uart, {
@@ -49,9 +52,13 @@ def test_toggler():
 
             return m
 
+        def ports(self):
+            return [self.uart.test_bypass_rx_data, self.uart.test_bypass_rx_stb,
+                    self.uart.tx_o, self.toggler.output]
+
     rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
 
     def wait(n):
         for i in range(n):
@@ -61,15 +68,15 @@ def test_toggler():
         # Assert the toggler is off
         assert not (yield rig.toggler.output)
 
-        yield from rig.uart.test_send_char('1')
-        yield from wait(4)
+        yield from rig.uart.test_bypass_char('1')
+        yield from wait(5)
         assert (yield rig.toggler.output)
 
-        yield from rig.uart.test_send_char('1')
-        yield from wait(4)
+        yield from rig.uart.test_bypass_char('1')
+        yield from wait(5)
         assert not (yield rig.toggler.output)
 
     sim.add_sync_process(transmit_proc)
 
-    with sim.write_vcd("toggler.vcd"):
+    with trace(sim, "toggler.vcd"):
         sim.run()
@@ -19,21 +19,18 @@ class Trigger(CommandTask):
         start_last = Signal()
         m.d.sync += start_last.eq(self.start)
 
-        with m.FSM() as fsm:
-            with m.State("IDLE"):
-                with m.If(self.start & ~start_last):
-                    m.d.sync += self.output.eq(1)
-                    m.d.sync += self.done.eq(1)
-                    m.next = "FINISH"
-            with m.State("FINISH"):
-                    m.d.sync += self.output.eq(0)
-                    m.d.sync += self.done.eq(0)
-                    m.next = "IDLE"
+        # The output pulses for the one cycle start rises, which also ends the task
+        pulse = Signal()
+        m.d.comb += [
+            pulse.eq(self.start & ~start_last),
+            self.output.eq(pulse),
+            self.done.eq(pulse),
+        ]
 
         return m
 
 def test_trigger():
-    from nmigen.sim import Simulator
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
     from serialcommander.commander import Commander
     from serialcommander.uart import UART
 
@@ -42,7 +39,7 @@ def test_trigger():
             m = Module()
 
             self.trigger = Trigger()
-            self.uart = UART(divisor=5)
+            self.uart = UART(divisor=TEST_DIVISOR)
 
             self.counter = Signal(3)
             with m.If(self.trigger.output):
@@ -55,9 +52,12 @@ def test_trigger():
 
             return m
 
+        def ports(self):
+            return [self.uart.rx_i, self.uart.tx_o, self.counter]
+
     rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
 
     def wait(n):
         for i in range(n):
@@ -67,13 +67,12 @@ def test_trigger():
         assert (yield rig.counter) == 0
 
         # Increment 3 times
-        for i in range(3):
-            yield from rig.uart.test_send_char('1')
-            yield from wait(5)
+        yield from rig.uart.test_send_string('111')
+        yield from wait(5)
 
         assert (yield rig.counter) == 3
 
     sim.add_sync_process(transmit_proc)
 
-    with sim.write_vcd("trigger.vcd"):
+    with trace(sim, "trigger.vcd"):
         sim.run()
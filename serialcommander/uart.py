@@ -1,9 +1,12 @@
+from functools import lru_cache
+
 from nmigen import (
     Cat,
     C,
     Elaboratable,
     Signal,
-    Module
+    Module,
+    Mux
 )
 from nmigen.build import Platform
 
@@ -14,6 +17,9 @@ class UART(Elaboratable):
     divisor : int
         Set to ``round(clk-rate / baud-rate)``.
         E.g. ``12e6 / 115200`` = ``104``.
+    fractional : bool
+        Time bits in sixteenths of a clock cycle so ``divisor`` can be
+        fractional, e.g. ``12e6 / 115200`` = ``104.1875``.
 
     Based off of the nmigen example UART
 
@@ -21,11 +27,14 @@ class UART(Elaboratable):
     Copyright (C) 2011-2019 M-Labs Limited
 
     """
-    def __init__(self, divisor: int, data_bits: int=8):
+    def __init__(self, divisor: int, data_bits: int=8, fractional: bool=False):
         assert divisor >= 4
 
-        self.data_bits = data_bits
-        self.divisor   = divisor
+        self.data_bits  = data_bits
+        self.divisor    = divisor
+        self.fractional = fractional
+        # Bit period in sixteenths of a clock cycle
+        self._period    = round(divisor * 16)
 
         self.tx_o    = Signal()
         self.rx_i    = Signal(reset=1)
@@ -40,88 +49,170 @@ class UART(Elaboratable):
         self.rx_rdy  = Signal()
         self.rx_ack  = Signal()
 
+        # Simulation only, hands a byte straight to rx_data without a frame
+        self.test_bypass_rx_data = Signal(data_bits)
+        self.test_bypass_rx_stb  = Signal()
+
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        tx_phase = Signal(range(self.divisor))
+        # tx_tick marks the last cycle of each bit period
+        tx_tick = Signal()
+        if self.fractional:
+            # Whatever is left over from each bit carries into the next
+            tx_acc = Signal(range(self._period + 16))
+            m.d.comb += tx_tick.eq(tx_acc + 16 >= self._period)
+            tx_restart = tx_acc.eq(0)
+            tx_advance = tx_acc.eq(Mux(tx_tick, tx_acc + 16 - self._period, tx_acc + 16))
+        else:
+            tx_phase = Signal(range(self.divisor))
+            m.d.comb += tx_tick.eq(tx_phase == 0)
+            tx_restart = tx_phase.eq(self.divisor - 1)
+            tx_advance = tx_phase.eq(Mux(tx_tick, self.divisor - 1, tx_phase - 1))
+
         tx_shreg = Signal(1 + self.data_bits + 1, reset=-1)
         tx_count = Signal(range(len(tx_shreg) + 1))
+        # Index of the bit on the line, which rests on the (high) stop bit
+        # between frames so the frame itself never has to be shifted
+        tx_bit_idx = Signal(range(len(tx_shreg)), reset=len(tx_shreg) - 1)
 
-        m.d.comb += self.tx_o.eq(tx_shreg[0])
+        m.d.comb += self.tx_o.eq(tx_shreg.bit_select(tx_bit_idx, 1))
         with m.If(tx_count == 0):
             m.d.comb += self.tx_ack.eq(1)
             with m.If(self.tx_rdy):
                 m.d.sync += [
                     tx_shreg.eq(Cat(C(0, 1), self.tx_data, C(1, 1))),
                     tx_count.eq(len(tx_shreg)),
-                    tx_phase.eq(self.divisor - 1),
+                    tx_bit_idx.eq(0),
+                    tx_restart,
                 ]
         with m.Else():
-            with m.If(tx_phase != 0):
-                m.d.sync += tx_phase.eq(tx_phase - 1)
-            with m.Else():
-                m.d.sync += [
-                    tx_shreg.eq(Cat(tx_shreg[1:], C(1, 1))),
-                    tx_count.eq(tx_count - 1),
-                    tx_phase.eq(self.divisor - 1),
-                ]
-
-        rx_phase = Signal(range(self.divisor))
-        rx_shreg = Signal(1 + self.data_bits + 2, reset=-1)
+            m.d.sync += tx_advance
+            with m.If(tx_tick):
+                m.d.sync += tx_count.eq(tx_count - 1)
+                with m.If(tx_bit_idx != len(tx_shreg) - 1):
+                    m.d.sync += tx_bit_idx.eq(tx_bit_idx + 1)
+
+        # rx_tick marks the cycle each bit is sampled, which
+        # after a restart is about half way into the start bit
+        rx_tick = Signal()
+        if self.fractional:
+            rx_acc = Signal(range(self._period + 16))
+            m.d.comb += rx_tick.eq(rx_acc + 16 >= self._period)
+            rx_restart = rx_acc.eq(self._period // 2)
+            rx_advance = rx_acc.eq(Mux(rx_tick, rx_acc + 16 - self._period, rx_acc + 16))
+        else:
+            rx_phase = Signal(range(self.divisor))
+            m.d.comb += rx_tick.eq(rx_phase == 0)
+            rx_restart = rx_phase.eq(self.divisor // 2)
+            rx_advance = rx_phase.eq(Mux(rx_tick, self.divisor - 1, rx_phase - 1))
+
+        # Each sample is a majority vote over rx_i and its previous two
+        # cycles, all within the bit since divisor >= 4, to reject glitches
+        rx_hist = Signal(2, reset=-1)
+        rx_bit = Signal()
+        m.d.sync += rx_hist.eq(Cat(rx_hist[1:], self.rx_i))
+        m.d.comb += rx_bit.eq((rx_hist[0] & rx_hist[1]) |
+                              (rx_hist[0] & self.rx_i) |
+                              (rx_hist[1] & self.rx_i))
+
+        rx_shreg = Signal(1 + self.data_bits + 1, reset=-1)
         rx_count = Signal(range(len(rx_shreg) + 1))
 
-        m.d.comb += self.rx_data.eq(rx_shreg[1:-1])
+        # rx_rdy and rx_ovf are worked out combinationally below
+        # and then registered with a single assignment
+        rx_rdy_next = Signal()
+        rx_ovf_next = Signal()
+        m.d.comb += [
+            rx_rdy_next.eq(self.rx_rdy),
+            rx_ovf_next.eq(self.rx_ovf),
+        ]
+        m.d.sync += [
+            self.rx_rdy.eq(rx_rdy_next),
+            self.rx_ovf.eq(rx_ovf_next),
+        ]
+
+        with m.If(self.rx_ack):
+            m.d.comb += rx_rdy_next.eq(0)
+
+        # Frames are always received, even before the last byte is acked,
+        # so that back to back frames aren't missed. A frame only starts once
+        # the line has been high since the last stop bit, so a line held low
+        # after a bad stop bit isn't taken for a new frame
+        rx_armed = Signal(reset=1)
         with m.If(rx_count == 0):
-            m.d.comb += self.rx_err.eq(~(~rx_shreg[0] & rx_shreg[-1]))
-            with m.If(~self.rx_i):
-                with m.If(self.rx_ack | ~self.rx_rdy):
-                    m.d.sync += [
-                        self.rx_rdy.eq(0),
-                        self.rx_ovf.eq(0),
-                        rx_count.eq(len(rx_shreg)),
-                        rx_phase.eq(self.divisor // 2),
-                    ]
-                with m.Else():
-                    m.d.sync += self.rx_ovf.eq(1)
-            with m.If(self.rx_ack):
-                m.d.sync += self.rx_rdy.eq(0)
+            with m.If(self.rx_i):
+                m.d.sync += rx_armed.eq(1)
+            with m.Elif(rx_armed):
+                m.d.sync += [
+                    self.rx_err.eq(0),
+                    rx_count.eq(len(rx_shreg)),
+                    rx_restart,
+                ]
         with m.Else():
-            with m.If(rx_phase != 0):
-                m.d.sync += rx_phase.eq(rx_phase - 1)
-            with m.Else():
+            m.d.sync += rx_advance
+            with m.If(rx_tick):
                 m.d.sync += [
-                    rx_shreg.eq(Cat(rx_shreg[1:], self.rx_i)),
+                    # Store each sample in place rather than shifting them all
+                    rx_shreg.bit_select(len(rx_shreg) - rx_count, 1).eq(rx_bit),
                     rx_count.eq(rx_count - 1),
-                    rx_phase.eq(self.divisor - 1),
                 ]
                 with m.If(rx_count == 1):
-                    m.d.sync += self.rx_rdy.eq(1)
+                    # The stop bit is being sampled now, so check the framing
+                    # once here and hold the result until the next start bit
+                    m.d.sync += [
+                        self.rx_err.eq(~(~rx_shreg[0] & rx_bit)),
+                        rx_armed.eq(rx_bit),
+                    ]
+                    # Only hand the byte over if the last one has been taken,
+                    # otherwise drop it and flag the overflow
+                    with m.If(self.rx_rdy & ~self.rx_ack):
+                        m.d.comb += rx_ovf_next.eq(1)
+                    with m.Else():
+                        m.d.comb += [
+                            rx_rdy_next.eq(1),
+                            rx_ovf_next.eq(0),
+                        ]
+                        m.d.sync += self.rx_data.eq(rx_shreg[1:-1])
+
+        if platform is None:
+            with m.If(self.test_bypass_rx_stb):
+                m.d.comb += rx_rdy_next.eq(1)
+                m.d.sync += [
+                    self.rx_data.eq(self.test_bypass_rx_data),
+                    self.rx_err.eq(0),
+                ]
 
         return m
 
-    def test_send_char(self, char: str):
-        char = ord(char)
-
-        # Start bit
-        yield self.rx_i.eq(0)
-        for i in range(self.divisor):
-            yield 
-
-        # Data bits
-        for i in range(8):
-            yield self.rx_i.eq(1 if ((1 << i) & char) else 0)
-            for i in range(self.divisor):
-                yield 
-
-        # Stop bit
-        yield self.rx_i.eq(0)
-        for i in range(self.divisor):
-            yield 
+    def test_bypass_char(self, char: str):
+        """Receives ``char`` in a single cycle without simulating its frame,
+        for designs elaborated without a platform"""
+        yield self.test_bypass_rx_data.eq(ord(char))
+        yield self.test_bypass_rx_stb.eq(1)
+        yield
+        yield self.test_bypass_rx_stb.eq(0)
 
-        # Put things back high
-        yield self.rx_i.eq(1)
-        for i in range(self.divisor):
-            yield 
+    def test_send_char(self, char: str):
+        yield from self.test_send_string(char)
+
+    def test_send_string(self, string: str):
+        # Each character's start bit, data bits and stop bit back to back,
+        # and then a bit of idle
+        pattern = []
+        for char in string:
+            pattern += _frame_bits(ord(char), self.data_bits)
+        pattern.append(1)
+
+        # Hold rx_i for each run of equal bits in one go, so it's only written
+        # when the level changes. Bit k starts on cycle int(k * divisor) so
+        # fractional divisors keep their timing
+        start = 0
+        for k in range(1, len(pattern) + 1):
+            if k == len(pattern) or pattern[k] != pattern[start]:
+                yield from _hold(self.rx_i, pattern[start],
+                                 int(k * self.divisor) - int(start * self.divisor))
+                start = k
 
     def test_receive_char(self) -> str:
         # Wait for signal to go low
@@ -130,40 +221,73 @@ class UART(Elaboratable):
                 break
             yield
 
-        # Wait for half the divisor to get to the
-        # center of the bit
-        for i in range(self.divisor//2):
-            yield
-
-        # Read each bit
+        # Read each bit at its center, counting cycles from the
+        # start of the frame so fractional divisors don't drift
+        cycle = 0
         out = 0
         for i in range(8):
-            for _ in range(self.divisor):
+            center = int((i + 1.5) * self.divisor)
+            for _ in range(center - cycle):
                 yield
+            cycle = center
             if (yield self.tx_o):
                 out += (1 << i)
 
-        # Don't care about stop bit
-        for i in range(self.divisor):
+        # Don't care about stop bit beyond getting to its center
+        for _ in range(int(9.5 * self.divisor) - cycle):
             yield
 
         return chr(out)
 
     def test_expect_string(self, string: str) -> bool:
-        for c in string:
-            r = yield from self.test_receive_char()
-            if r != c:
-                raise Exception("Expected {} but got {}".format(c, r))
+        # Characters aren't sent back to back, so each one has to be found
+        # and decoded on its own, but they're only compared once at the end
+        received = []
+        for _ in string:
+            received.append((yield from self.test_receive_char()))
+        received = "".join(received)
+        if received != string:
+            raise Exception("Expected {!r} but got {!r}".format(string, received))
         return True
 
+@lru_cache(maxsize=None)
+def _frame_bits(char: int, data_bits: int) -> tuple:
+    """The start bit, data bits (LSB first) and stop bit of a frame"""
+    return (0,) + tuple((char >> i) & 1 for i in range(data_bits)) + (1,)
+
+def _hold(signal: Signal, value: int, cycles: int):
+    """Drives ``signal`` to ``value`` for ``cycles`` clock cycles in a test process"""
+    yield signal.eq(value)
+    for _ in range(cycles):
+        yield
+
+class _RXTestRig(Elaboratable):
+    """A bare UART whose ``rx_i`` is driven by the test process"""
+    def __init__(self, divisor: float, fractional: bool = False):
+        self.divisor = divisor
+        self.fractional = fractional
+
+    def elaborate(self, platform: Platform):
+        m = Module()
+
+        m.submodules.uart = uart = UART(divisor=self.divisor, fractional=self.fractional)
+        self.uart = uart
+
+        return m
+
+    def ports(self):
+        uart = self.uart
+        return [uart.rx_i, uart.tx_o, uart.tx_data, uart.tx_rdy,
+                uart.rx_data, uart.rx_err, uart.rx_rdy, uart.rx_ovf, uart.rx_ack]
+
 def test_uart_loopback():
-    from nmigen.sim import Simulator, Passive
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
 
     class TestRig(Elaboratable):
         def elaborate(self, platform: Platform):
             m = Module()
 
-            m.submodules.uart = uart = UART(divisor=5)
+            m.submodules.uart = uart = UART(divisor=TEST_DIVISOR)
             self.uart = uart
 
             m.d.comb += [
@@ -172,9 +296,14 @@ def test_uart_loopback():
 
             return m
 
+        def ports(self):
+            uart = self.uart
+            return [uart.tx_data, uart.tx_rdy, uart.tx_ack,
+                    uart.rx_data, uart.rx_err, uart.rx_rdy, uart.rx_ack]
+
     rig = TestRig()
-    sim = Simulator(rig)
-    sim.add_clock(1e-6)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
 
     def transmit_proc():
         test_byte = 0x72
@@ -196,7 +325,7 @@ def test_uart_loopback():
         assert not (yield rig.uart.tx_ack)
 
         # Wait for the data to be send
-        for _ in range(rig.uart.divisor * 12): yield
+        for _ in range(int(rig.uart.divisor * 12)): yield
 
         # Assert that we're acked and ready to go
         assert (yield rig.uart.tx_ack)
@@ -212,5 +341,178 @@ def test_uart_loopback():
 
     sim.add_sync_process(transmit_proc)
 
-    with sim.write_vcd("uart.vcd"):
+    with trace(sim, "uart.vcd"):
+        sim.run()
+
+def test_uart_glitch():
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
+
+    rig = _RXTestRig(TEST_DIVISOR)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
+
+    def transmit_proc():
+        char = ord('r')
+        bits = _frame_bits(char, 8) + (1,)
+
+        # Flip every data bit for a single cycle, at each point in the bit in turn
+        for glitch in range(rig.uart.divisor):
+            for k, bit in enumerate(bits):
+                for i in range(rig.uart.divisor):
+                    flip = 1 <= k <= 8 and i == glitch
+                    yield rig.uart.rx_i.eq(bit ^ flip)
+                    yield
+            yield
+
+            assert (yield rig.uart.rx_rdy)
+            assert not (yield rig.uart.rx_err)
+            assert (yield rig.uart.rx_data) == char
+
+            yield rig.uart.rx_ack.eq(1)
+            yield
+            yield rig.uart.rx_ack.eq(0)
+
+    sim.add_sync_process(transmit_proc)
+
+    with trace(sim, "uart_glitch.vcd"):
+        sim.run()
+
+def test_uart_framing_error():
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
+
+    rig = _RXTestRig(TEST_DIVISOR)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
+
+    def transmit_proc():
+        divisor = rig.uart.divisor
+        assert not (yield rig.uart.rx_err)
+
+        # A frame with a low stop bit
+        yield from _hold(rig.uart.rx_i, 0, 11 * divisor)
+        assert (yield rig.uart.rx_rdy)
+        assert (yield rig.uart.rx_err)
+
+        # A line held low afterwards is a break, not another frame
+        yield rig.uart.rx_ack.eq(1)
+        yield
+        yield rig.uart.rx_ack.eq(0)
+        yield from _hold(rig.uart.rx_i, 0, 20 * divisor)
+        assert not (yield rig.uart.rx_rdy)
+        assert (yield rig.uart.rx_err)
+
+        # The error sticks around while the line is idle, even once read
+        yield from _hold(rig.uart.rx_i, 1, 4 * divisor)
+        assert (yield rig.uart.rx_err)
+
+        # Until the next frame starts
+        yield from _hold(rig.uart.rx_i, 0, divisor)
+        assert not (yield rig.uart.rx_err)
+        yield from _hold(rig.uart.rx_i, 1, 10 * divisor)
+        assert (yield rig.uart.rx_rdy)
+        assert not (yield rig.uart.rx_err)
+        assert (yield rig.uart.rx_data) == 0xff
+
+    sim.add_sync_process(transmit_proc)
+
+    with trace(sim, "uart_framing_error.vcd"):
         sim.run()
+
+def test_uart_overrun():
+    from serialcommander.sim_backend import CLOCK_PERIOD, TEST_DIVISOR, simulator, trace
+
+    rig = _RXTestRig(TEST_DIVISOR)
+    sim = simulator(rig)
+    sim.add_clock(CLOCK_PERIOD)
+
+    def transmit_proc():
+        # A second frame before the first is acked is dropped
+        yield from rig.uart.test_send_char('a')
+        assert (yield rig.uart.rx_rdy)
+        assert not (yield rig.uart.rx_ovf)
+        yield from rig.uart.test_send_char('b')
+        assert (yield rig.uart.rx_rdy)
+        assert (yield rig.uart.rx_ovf)
+        assert (yield rig.uart.rx_data) == ord('a')
+
+        # The overflow is kept until a frame is received after the ack
+        yield rig.uart.rx_ack.eq(1)
+        yield
+        yield rig.uart.rx_ack.eq(0)
+        yield
+        assert not (yield rig.uart.rx_rdy)
+        assert (yield rig.uart.rx_ovf)
+        yield from rig.uart.test_send_char('c')
+        assert (yield rig.uart.rx_rdy)
+        assert not (yield rig.uart.rx_ovf)
+        assert (yield rig.uart.rx_data) == ord('c')
+
+    sim.add_sync_process(transmit_proc)
+
+    with trace(sim, "uart_overrun.vcd"):
+        sim.run()
+
+def test_uart_fractional():
+    from serialcommander.sim_backend import CLOCK_PERIOD, simulator, trace
+
+    # Rounding either of these to a whole number of cycles would be off by
+    # more than half a bit by the end of a frame
+    for divisor in [4.5, 4.75]:
+        rig = _RXTestRig(divisor, fractional=True)
+        sim = simulator(rig)
+        sim.add_clock(CLOCK_PERIOD)
+
+        def transmit_proc():
+            # Receive a byte timed by the test bench
+            yield from rig.uart.test_send_char('r')
+            yield
+            assert (yield rig.uart.rx_rdy)
+            assert not (yield rig.uart.rx_err)
+            assert (yield rig.uart.rx_data) == ord('r')
+
+            yield rig.uart.rx_ack.eq(1)
+            yield
+            yield rig.uart.rx_ack.eq(0)
+
+            # And send one back
+            yield rig.uart.tx_data.eq(ord('r'))
+            yield rig.uart.tx_rdy.eq(1)
+            yield
+            yield rig.uart.tx_rdy.eq(0)
+            assert (yield from rig.uart.test_receive_char()) == 'r'
+
+        sim.add_sync_process(transmit_proc)
+
+        with trace(sim, "uart_fractional_{}.vcd".format(divisor)):
+            sim.run()
+
+    # Just over 4 leaves little room either side of each sample, so check
+    # that back to back frames still line up
+    string = "Hi\0\xff\x55"
+    for divisor in [4.0625, 4.125, 4.25]:
+        rig = _RXTestRig(divisor, fractional=True)
+        sim = simulator(rig)
+        sim.add_clock(CLOCK_PERIOD)
+        received = []
+
+        def send_proc():
+            yield from rig.uart.test_send_string(string)
+
+        def receive_proc():
+            for _ in range(int(11 * len(string) * divisor)):
+                if (yield rig.uart.rx_rdy):
+                    assert not (yield rig.uart.rx_err)
+                    assert not (yield rig.uart.rx_ovf)
+                    received.append(chr((yield rig.uart.rx_data)))
+                    yield rig.uart.rx_ack.eq(1)
+                    yield
+                    yield rig.uart.rx_ack.eq(0)
+                yield
+
+        sim.add_sync_process(send_proc)
+        sim.add_sync_process(receive_proc)
+
+        with trace(sim, "uart_fractional_string_{}.vcd".format(divisor)):
+            sim.run()
+
+        assert "".join(received) == string